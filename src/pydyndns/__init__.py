@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
-import abc
+from __future__ import annotations
+
 import argparse
+import copy
 import ipaddress
 import json
 import logging
@@ -9,49 +11,54 @@ import logging.config
 import logging.handlers
 import os
 import pathlib
+import queue
 import socket
 import sys
+import threading
+import time
 import typing
 
-import dns.name
-import dns.rdataclass
-import dns.rdatatype
-import dns.rdtypes.IN.A
-import dns.rdtypes.IN.AAAA
-import dns.resolver
-import dns.tsigkeyring
-import dns.update
-import ifaddr
+# dnspython takes longer to import than the rest of the program put together,
+# yet it is not needed at all to print help, to report a bad configuration
+# file, or when the cache shows nothing has changed. It and ifaddr are
+# therefore imported only by the functions that use them; these imports are
+# just for annotations.
+if typing.TYPE_CHECKING:
+    import dns.message
+    import dns.name
+    import dns.update
+    import ifaddr
 
 
 IPAddressUnion = typing.Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
 
 
-class IPAddressEnabledJSONEncoder(json.JSONEncoder):
-    """
-    A JSON encoder that is capable of encoding IP address objects into strings.
-    """
-    def default(self, obj: typing.Any) -> typing.Any:
-        if isinstance(obj, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
-            return str(obj)
-        else:
-            return super().default(obj)
+# How long, in seconds, each of a nameserver’s addresses is given to handle an
+# update before the next address is tried as well.
+_SEND_STAGGER = 0.25
+
 
+# The TSIG algorithms that may be named in the configuration file, mapped to
+# their names on the wire (the same names as in dns.tsig, spelled out so that
+# dnspython need not be imported just to check the configuration).
+_TSIG_ALGORITHMS: typing.Mapping[str, str] = {
+    "hmac-md5": "HMAC-MD5.SIG-ALG.REG.INT.",
+    "hmac-sha1": "hmac-sha1.",
+    "hmac-sha224": "hmac-sha224.",
+    "hmac-sha256": "hmac-sha256.",
+    "hmac-sha384": "hmac-sha384.",
+    "hmac-sha512": "hmac-sha512.",
+}
 
-class Platform(metaclass=abc.ABCMeta):
+
+class Platform(typing.Protocol):
     """
     Encapsulates knowledge about a specific operating system.
     """
 
-    __slots__ = ()
-
-    @property
-    @abc.abstractmethod
-    def name(self) -> str:
-        """The name as shown in os.name."""
-        pass
+    name: str
+    """The name as shown in os.name."""
 
-    @abc.abstractmethod
     def permanent_ipv6_addresses(self, addresses: typing.List[ipaddress.IPv6Address]) -> typing.List[ipaddress.IPv6Address]:
         """
         Return only the IPv6 addresses that are permanent (i.e. not generated
@@ -69,19 +76,12 @@ class Platform(metaclass=abc.ABCMeta):
         """
         pass
 
-    @property
-    @abc.abstractmethod
-    def default_config_filename(self) -> pathlib.Path:
-        """Return the default location of the configuration file."""
-        pass
+    default_config_filename: pathlib.Path
+    """The default location of the configuration file."""
 
-    @property
-    @abc.abstractmethod
-    def default_cache_filename(self) -> pathlib.Path:
-        """Return the default location of the cache file."""
-        pass
+    default_cache_filename: pathlib.Path
+    """The default location of the cache file."""
 
-    @abc.abstractmethod
     def platform_specific_setup(self) -> None:
         """
         Do any work that is specific to this platform for initializing the
@@ -89,59 +89,58 @@ class Platform(metaclass=abc.ABCMeta):
         """
         pass
 
+    def sync_directory(self, directory: pathlib.Path) -> None:
+        """
+        Make sure changes to the entries of a directory (e.g. a file renamed
+        into it) have reached the disk, where the platform allows that.
+        """
+        pass
+
 
-class POSIXPlatform(Platform):
+class POSIXPlatform:
     __slots__ = ()
 
-    @property
-    def name(self) -> str:
-        return "posix"
+    name = "posix"
 
     def permanent_ipv6_addresses(self, addresses: typing.List[ipaddress.IPv6Address]) -> typing.List[ipaddress.IPv6Address]:
-        # Linux returns permanent addresses last.
-        if len(addresses) == 0:
-            return []
-        else:
-            return [addresses[-1]]
-
-    @property
-    def default_config_filename(self) -> pathlib.Path:
-        return pathlib.Path("/etc/pydyndns.conf")
+        # Linux returns permanent addresses last. Slicing also copes with an
+        # empty list.
+        return addresses[-1:]
 
-    @property
-    def default_cache_filename(self) -> pathlib.Path:
-        return pathlib.Path("/run/pydyndns.cache")
+    default_config_filename = pathlib.Path("/etc/pydyndns.conf")
+    default_cache_filename = pathlib.Path("/run/pydyndns.cache")
 
     def platform_specific_setup(self) -> None:
         pass
 
+    def sync_directory(self, directory: pathlib.Path) -> None:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
-class WindowsPlatform(Platform):
-    __slots__ = ()
-
-    @property
-    def name(self) -> str:
-        return "nt"
 
-    def permanent_ipv6_addresses(self, addresses: typing.List[ipaddress.IPv6Address]) -> typing.List[ipaddress.IPv6Address]:
-        # Windows returns permanent addresses first.
-        if len(addresses) == 0:
-            return []
-        else:
-            return [addresses[0]]
+class WindowsPlatform:
+    __slots__ = (
+        "default_config_filename",
+        "default_cache_filename",
+    )
 
-    @property
-    def default_config_filename(self) -> pathlib.Path:
-        return pathlib.Path(__file__).parent / "pydyndns.conf"
+    name = "nt"
 
-    @property
-    def default_cache_filename(self) -> pathlib.Path:
+    def __init__(self) -> None:
+        self.default_config_filename = pathlib.Path(__file__).parent / "pydyndns.conf"
         env_var = os.environ.get("LOCALAPPDATA")
         if env_var is None:
             local_app_data = pathlib.Path.home() / "AppData" / "Local"
         else:
             local_app_data = pathlib.Path(env_var)
-        return local_app_data / "Temp" / "pydyndns.cache"
+        self.default_cache_filename = local_app_data / "Temp" / "pydyndns.cache"
+
+    def permanent_ipv6_addresses(self, addresses: typing.List[ipaddress.IPv6Address]) -> typing.List[ipaddress.IPv6Address]:
+        # Windows returns permanent addresses first.
+        return addresses[:1]
 
     def platform_specific_setup(self) -> None:
         # Python’s NTEventLogHandler class unconditionally tries to add the
@@ -165,113 +164,435 @@ class WindowsPlatform(Platform):
             # Guess Win32 extensions are not installed.
             pass
 
+    def sync_directory(self, directory: pathlib.Path) -> None:
+        # Directories cannot be opened, let alone flushed, on Windows; NTFS
+        # journals the rename itself.
+        pass
+
 
-class UnknownPlatform(Platform):
+class UnknownPlatform:
     __slots__ = ()
 
-    @property
-    def name(self) -> str:
-        return "unknown"
+    name = "unknown"
 
     def permanent_ipv6_addresses(self, addresses: typing.List[ipaddress.IPv6Address]) -> typing.List[ipaddress.IPv6Address]:
         # No idea what the convention is on this platform, so just return all
         # of them.
         return addresses
 
-    @property
-    def default_config_filename(self) -> pathlib.Path:
-        return pathlib.Path("pydyndns.conf")
-
-    @property
-    def default_cache_filename(self) -> pathlib.Path:
-        return pathlib.Path("pydyndns.cache")
+    default_config_filename = pathlib.Path("pydyndns.conf")
+    default_cache_filename = pathlib.Path("pydyndns.cache")
 
     def platform_specific_setup(self) -> None:
         pass
 
+    def sync_directory(self, directory: pathlib.Path) -> None:
+        pass
+
 
-class Family(metaclass=abc.ABCMeta):
+class Family(typing.Protocol):
     """
     Encapsulates knowledge about a specific address family.
     """
 
-    __slots__ = ()
+    name: str
+    """The name used as a cache key for addresses in this family."""
 
-    @property
-    @abc.abstractmethod
-    def name(self) -> str:
-        """The name used as a cache key for addresses in this family."""
-        pass
+    version: int
+    """The IP version number of addresses in this family."""
 
-    @abc.abstractmethod
     def add_address_to_update(self, update: dns.update.Update, hostPart: dns.name.Name, ttl: int, address: IPAddressUnion) -> None:
         """Add an address in this family to a DNS update request."""
         pass
 
-    @abc.abstractmethod
+    def add_prerequisite_to_update(self, update: dns.update.Update, hostPart: dns.name.Name, address: str) -> None:
+        """
+        Add a prerequisite to a DNS update request that an address in this
+        family, given in textual form, must already be registered.
+        """
+        pass
+
     def filter_address_list(self, addresses: typing.Iterable[ifaddr.IP]) -> typing.Iterable[IPAddressUnion]:
         """
-        Return only those addresses that are of this family and are useful,
-        e.g. not loopback, link-local, temporary, or other special addresses
-        that should not be registered, converting them to the standard Python
-        IP address types.
+        Return only those addresses that are useful, e.g. not loopback,
+        link-local, temporary, or other special addresses that should not be
+        registered, converting them to the standard Python IP address types.
+
+        The caller must pass only addresses of this family.
         """
         pass
 
 
-class IPv4(Family):
+class IPv4:
     __slots__ = ()
 
-    @property
-    def name(self) -> str:
-        return "ipv4"
+    name = "ipv4"
+    version = 4
 
     def add_address_to_update(self, update: dns.update.Update, hostPart: dns.name.Name, ttl: int, address: IPAddressUnion) -> None:
         assert isinstance(address, ipaddress.IPv4Address)
+        import dns.rdataclass
+        import dns.rdatatype
+        import dns.rdtypes.IN.A
         update.add(hostPart, ttl, dns.rdtypes.IN.A.A(dns.rdataclass.IN, dns.rdatatype.A, str(address)))
 
+    def add_prerequisite_to_update(self, update: dns.update.Update, hostPart: dns.name.Name, address: str) -> None:
+        import dns.rdataclass
+        import dns.rdatatype
+        import dns.rdtypes.IN.A
+        update.present(hostPart, dns.rdtypes.IN.A.A(dns.rdataclass.IN, dns.rdatatype.A, address))
+
     def filter_address_list(self, addresses: typing.Iterable[ifaddr.IP]) -> typing.Iterable[ipaddress.IPv4Address]:
         # For IPv4 most NICs have only one address. It’s not clear that there
         # are any specific rules about how multiple addresses ought to be
         # handled. Just include all of them that are acceptable.
-        return filter(self.include_address, map(lambda i: ipaddress.IPv4Address(i.ip), filter(lambda i: i.is_IPv4, addresses)))
+        #
+        # Parse the textual addresses with inet_pton and build the address
+        # objects from the packed form, which is several times faster than
+        # having ipaddress parse the text itself. The caller only iterates
+        # over the result once, so produce it lazily rather than building a
+        # list.
+        return (address for address in (ipaddress.IPv4Address(socket.inet_pton(socket.AF_INET, typing.cast(str, i.ip))) for i in addresses) if self.include_address(address))
 
     def include_address(self, address: ipaddress.IPv4Address) -> bool:
-        return (address.is_private or address.is_global) and not address.is_link_local and not address.is_loopback
+        # Every address is private or global except the shared address space
+        # (100.64.0.0/10); exclude that along with link-local (169.254.0.0/16)
+        # and loopback (127.0.0.0/8). Testing the prefixes directly on the
+        # integer value avoids the ipaddress properties, each of which checks
+        # the address against a list of networks.
+        value = int(address)
+        return value >> 22 != 0x191 and value >> 16 != 0xA9FE and value >> 24 != 127
 
 
-class IPv6(Family):
+class IPv6:
     __slots__ = (
         "_platform",
-        "_config",
+        "_allow_teredo",
     )
 
+    name = "ipv6"
+    version = 6
+
     def __init__(self, platform: Platform, config: typing.Mapping[typing.Any, typing.Any]):
         self._platform = platform
-        self._config = config
-
-    @property
-    def name(self) -> str:
-        return "ipv6"
+        self._allow_teredo = bool(config["teredo"])
 
     def add_address_to_update(self, update: dns.update.Update, hostPart: dns.name.Name, ttl: int, address: IPAddressUnion) -> None:
         assert isinstance(address, ipaddress.IPv6Address)
+        import dns.rdataclass
+        import dns.rdatatype
+        import dns.rdtypes.IN.AAAA
         update.add(hostPart, ttl, dns.rdtypes.IN.AAAA.AAAA(dns.rdataclass.IN, dns.rdatatype.AAAA, str(address)))
 
+    def add_prerequisite_to_update(self, update: dns.update.Update, hostPart: dns.name.Name, address: str) -> None:
+        import dns.rdataclass
+        import dns.rdatatype
+        import dns.rdtypes.IN.AAAA
+        update.present(hostPart, dns.rdtypes.IN.AAAA.AAAA(dns.rdataclass.IN, dns.rdatatype.AAAA, address))
+
     def filter_address_list(self, addresses: typing.Iterable[ifaddr.IP]) -> typing.Iterable[ipaddress.IPv6Address]:
-        return self._platform.permanent_ipv6_addresses(list(filter(self.include_address, map(lambda i: ipaddress.IPv6Address(i.ip[0]), filter(lambda i: i.is_IPv6, addresses)))))
+        # As for IPv4, parse with inet_pton rather than ipaddress.
+        return self._platform.permanent_ipv6_addresses([address for address in (ipaddress.IPv6Address(socket.inet_pton(socket.AF_INET6, i.ip[0])) for i in addresses) if self.include_address(address)])
 
     def include_address(self, address: ipaddress.IPv6Address) -> bool:
-        if address.teredo is not None and not self._config["teredo"]:
-            return False
-        return address.ipv4_mapped is None and (address.is_private or address.is_global) and not address.is_link_local and not address.is_loopback
+        # As for IPv4, test the prefixes directly on the integer value, as one
+        # expression so that a typical (global) address costs a few integer
+        # comparisons and nothing else. Teredo addresses (2001::/32) are
+        # optional. Every address is private or global, so otherwise exclude
+        # only IPv4-mapped (::ffff:0:0/96), link-local (fe80::/10), and
+        # loopback (::1).
+        value = int(address)
+        return (self._allow_teredo or value >> 96 != 0x20010000) and value >> 32 != 0xFFFF and value >> 118 != 0x3FA and value != 1
+
+
+class NameserverUnreachableError(Exception):
+    """
+    Raised when an update could not be delivered to any of a nameserver’s
+    addresses.
+    """
+    pass
+
+
+class UpdateRefusedError(Exception):
+    """
+    Raised when a nameserver was contacted but refused an update.
+    """
+    pass
+
+
+class PrerequisiteFailedError(UpdateRefusedError):
+    """
+    Raised when a nameserver refused an update because the records it was
+    expected to replace are no longer present.
+    """
+    pass
+
+
+def find_nameserver(zone: dns.name.Name, logger: logging.Logger) -> typing.Tuple[str, typing.List[str], float]:
+    """
+    Find the nameserver to send updates for a zone to, using an SOA query.
+
+    zone -- the zone to be updated
+    logger -- a logger to log messages to
+
+    Returns a tuple of the nameserver’s hostname, its addresses, and the time
+    (as returned by time.time()) after which this information is stale.
+    """
+    import dns.rdatatype
+    import dns.resolver
+    rrset = dns.resolver.resolve(zone, dns.rdatatype.SOA, lifetime=30).rrset
+    if rrset is None or len(rrset) != 1:
+        raise Exception(f"Got {0 if rrset is None else len(rrset)} SOA records for zone {zone}, expected 1.")
+    server = rrset[0].mname.to_text(omit_final_dot=True)
+    logger.debug("Using nameserver %s.", server)
+    server_addresses = [str(sockaddr[0]) for (_, _, _, _, sockaddr) in socket.getaddrinfo(server, "domain", type=socket.SOCK_STREAM)]
+    return (server, server_addresses, time.time() + rrset.ttl)
+
+
+def registered_addresses(fqdn: dns.name.Name, server_address: str, logger: logging.Logger) -> typing.Optional[typing.FrozenSet[str]]:
+    """
+    Ask one address of a nameserver which addresses are registered for a name.
+
+    fqdn -- the name to look up
+    server_address -- the IP address of the nameserver to ask
+    logger -- a logger to log messages to
+
+    Returns the A and AAAA records found, as addresses in textual form, or None
+    if the nameserver could not be asked.
+    """
+    import dns.exception
+    import dns.flags
+    import dns.message
+    import dns.query
+    import dns.rcode
+    import dns.rdataclass
+    import dns.rdatatype
+    ret: typing.Set[str] = set()
+    for rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
+        query = dns.message.make_query(fqdn, rdtype)
+        try:
+            resp = dns.query.udp(query, where=server_address, timeout=5, ignore_unexpected=True)
+            if resp.flags & dns.flags.TC:
+                resp = dns.query.tcp(query, where=server_address, timeout=30)
+        except (OSError, dns.exception.DNSException) as exp:
+            logger.debug("Querying DNS server at %s failed: %s", server_address, exp)
+            return None
+        if resp.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            logger.debug("Querying DNS server at %s failed with rcode %s.", server_address, dns.rcode.to_text(resp.rcode()))
+            return None
+        rrset = resp.get_rrset(resp.answer, fqdn, dns.rdataclass.IN, rdtype)
+        if rrset is not None:
+            ret.update(str(ipaddress.ip_address(rdata.to_text())) for rdata in rrset)
+    return frozenset(ret)
+
+
+def send_update_to_address(update: dns.update.Update, server_address: str, fqdn: dns.name.Name, addresses: typing.AbstractSet[str], logger: logging.Logger) -> None:
+    """
+    Send an update to one address of a nameserver.
+
+    update -- the update to send
+    server_address -- the IP address to send the update to
+    fqdn -- the name whose records the update replaces
+    addresses -- the addresses, in textual form, that the update registers
+    logger -- a logger to log messages to
+
+    Raises OSError or dns.exception.DNSException if the nameserver could not
+    be contacted, or UpdateRefusedError if it refused the update.
+    """
+    import dns.exception
+    import dns.flags
+    import dns.query
+    import dns.rcode
+    # An update for a single host is small, so try UDP first, saving the TCP
+    # handshake. Fall back to TCP if the response is truncated or nothing comes
+    # back over UDP (e.g. because a firewall drops it).
+    logger.debug("Sending update to DNS server at %s.", server_address)
+    resp: typing.Optional[dns.message.Message]
+    try:
+        resp = dns.query.udp(update, where=server_address, timeout=5, ignore_unexpected=True)
+    except (OSError, dns.exception.Timeout) as exp:
+        logger.debug("Sending update to DNS server at %s over UDP failed, retrying over TCP: %s", server_address, exp)
+        resp = None
+    if resp is None or resp.flags & dns.flags.TC:
+        resp = dns.query.tcp(update, where=server_address, timeout=30)
+    rcode = resp.rcode()
+    if rcode == dns.rcode.NXRRSET:
+        # The records from the last update are gone. That may be because this
+        # very update has already been applied, by the UDP attempt above with
+        # only its reply lost, or by an attempt at another of the nameserver’s
+        # addresses; if so, the job is done. Otherwise somebody else changed
+        # them, and resending the update without its prerequisites would
+        # overwrite their change, which is just what the prerequisites are
+        # there to prevent.
+        if registered_addresses(fqdn, server_address, logger) == addresses:
+            logger.debug("DNS server at %s already holds the updated records.", server_address)
+            return
+        raise PrerequisiteFailedError("Update refused because the records from the last update are no longer present; use --force to overwrite them.")
+    elif rcode != dns.rcode.NOERROR:
+        raise UpdateRefusedError(f"Update failed with rcode {dns.rcode.to_text(rcode)}.")
+
+
+def send_update(update: dns.update.Update, server_addresses: typing.Sequence[str], fqdn: dns.name.Name, addresses: typing.AbstractSet[str], logger: logging.Logger) -> None:
+    """
+    Send an update to a nameserver, trying its addresses concurrently and
+    stopping as soon as one succeeds.
+
+    In the style of RFC 8305 (“Happy Eyeballs”), the attempts are staggered:
+    each address gets a head start of _SEND_STAGGER seconds over the next, so
+    that normally the first address handles the update alone, but a dead or
+    slow one delays the rest only briefly. An attempt also starts early once
+    all the ones before it have failed, and never starts once one has
+    succeeded.
+
+    update -- the update to send
+    server_addresses -- the IP addresses of the nameserver
+    fqdn -- the name whose records the update replaces
+    addresses -- the addresses, in textual form, that the update registers
+    logger -- a logger to log messages to
+
+    Raises UpdateRefusedError if the nameserver was contacted but refused the
+    update, or NameserverUnreachableError if none of the addresses could be
+    contacted.
+    """
+    import dns.exception
+    condition = threading.Condition()
+    failures = 0
+    finished = False
+    # Each attempt reports its address and, if it started, the exception it
+    # raised or None if it succeeded.
+    results: queue.SimpleQueue[typing.Tuple[str, bool, typing.Optional[BaseException]]] = queue.SimpleQueue()
+
+    def attempt(index: int, server_address: str) -> None:
+        nonlocal failures, finished
+        with condition:
+            condition.wait_for(lambda: finished or failures >= index, timeout=index * _SEND_STAGGER)
+            if finished:
+                results.put((server_address, False, None))
+                return
+        try:
+            # Each attempt gets its own copy of the update, because rendering
+            # a message records TSIG state in it that is then needed to check
+            # the response.
+            send_update_to_address(copy.deepcopy(update), server_address, fqdn, addresses, logger)
+        except BaseException as exp:
+            with condition:
+                failures += 1
+                condition.notify_all()
+            results.put((server_address, True, exp))
+            return
+        with condition:
+            finished = True
+            condition.notify_all()
+        results.put((server_address, True, None))
+
+    # The attempts run in daemon threads, so that once one has succeeded, the
+    # others (which may be stuck waiting for a dead address to time out) do
+    # not keep the process from exiting.
+    for (index, server_address) in enumerate(server_addresses):
+        threading.Thread(target=attempt, args=(index, server_address), name=f"pydyndns update {server_address}", daemon=True).start()
+
+    errors: typing.Dict[str, Exception] = {}
+    refusal: typing.Optional[UpdateRefusedError] = None
+    try:
+        for _ in server_addresses:
+            (server_address, started, exp) = results.get()
+            if not started:
+                # This attempt never started because another succeeded.
+                continue
+            elif exp is None:
+                # This update was successful, so no need to wait for the rest
+                # of the nameserver’s addresses.
+                return
+            elif isinstance(exp, (OSError, dns.exception.DNSException)):
+                # Hold onto the error, but don’t report it yet—another address
+                # may yet succeed.
+                errors[server_address] = exp
+            elif isinstance(exp, UpdateRefusedError):
+                # The nameserver answered but refused. Another address may
+                # still succeed, so only report this if nothing succeeds.
+                refusal = exp
+            else:
+                raise exp
+    finally:
+        # Make sure no attempts that have not started yet ever do.
+        with condition:
+            finished = True
+            condition.notify_all()
+
+    # All the nameserver’s addresses failed. Bail out.
+    if refusal is not None:
+        raise refusal
+    raise NameserverUnreachableError("Unable to contact any nameservers: " + "; ".join(f"{address}: {errors[address]}" for address in server_addresses))
+
+
+def cache_temp_filename(cache_file: pathlib.Path) -> pathlib.Path:
+    """
+    Return the name of the temporary file that is written and then renamed into
+    place to update a cache file.
+    """
+    return cache_file.with_name(cache_file.name + ".tmp")
+
+
+def check_cache(cache: typing.Any, logger: logging.Logger) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    """
+    Check the contents of a cache file, which may have been damaged, before
+    any of them are used.
+
+    cache -- the parsed contents of the cache file
+    logger -- a logger to log messages to
+
+    Returns the cache, less any optional entries that are invalid, or None if
+    the hostname or addresses are invalid and the whole cache must therefore
+    be ignored.
+    """
+    if not isinstance(cache, dict) or not isinstance(cache.get("hostname"), str):
+        return None
+    addresses = cache.get("addresses")
+    if not isinstance(addresses, dict) or not all(isinstance(i, list) and all(isinstance(j, str) for j in i) for i in addresses.values()):
+        return None
+    if "system_hostname" in cache and not isinstance(cache["system_hostname"], str):
+        del cache["system_hostname"]
+    server_expires = cache.get("server_expires")
+    server_addresses = cache.get("server_addresses")
+    if "zone" in cache and not (isinstance(cache["zone"], str) and isinstance(cache.get("server"), str) and isinstance(server_addresses, list) and server_addresses and all(isinstance(i, str) for i in server_addresses) and isinstance(server_expires, (int, float)) and not isinstance(server_expires, bool)):
+        logger.warning("Ignoring invalid cached nameserver.")
+        for i in ("zone", "server", "server_addresses", "server_expires"):
+            cache.pop(i, None)
+    return cache
+
+
+def interface_addresses(wanted_interfaces: typing.AbstractSet[str]) -> typing.Dict[str, typing.Dict[int, typing.List[ifaddr.IP]]]:
+    """
+    Find the addresses of the network interfaces, grouped by IP version.
+
+    ifaddr enumerates every interface and all its addresses in a single pass,
+    so this walks that result once, picking out the interfaces of interest by
+    name, rather than querying each interface individually.
+
+    wanted_interfaces -- the names of the interfaces to include, or an empty
+        set to include all of them
+
+    Returns a dict mapping each interface’s name to a dict mapping IP version
+    number (4 and 6) to that interface’s addresses.
+    """
+    import ifaddr
+    ret: typing.Dict[str, typing.Dict[int, typing.List[ifaddr.IP]]] = {}
+    for interface in ifaddr.get_adapters():
+        if not wanted_interfaces or interface.nice_name in wanted_interfaces:
+            # ifaddr returns each interface’s addresses of both families mixed
+            # together; split them up once so each family only sees its own.
+            ips_by_version: typing.Dict[int, typing.List[ifaddr.IP]] = {4: [], 6: []}
+            for ip in interface.ips:
+                ips_by_version[6 if ip.is_IPv6 else 4].append(ip)
+            ret[interface.name] = ips_by_version
+    return ret
 
 
 def run(platform: Platform, args: argparse.Namespace, config: typing.Mapping[typing.Any, typing.Any], logger: logging.Logger) -> None:
     """
     Run the program.
 
-    platform -- an instance of a subclass of Platform
+    platform -- an object implementing Platform
     args -- a module containing parsed command-line arguments
     config -- a dict containing the parsed configuration file
     logger -- a logger to log messages to
@@ -310,123 +631,178 @@ def run(platform: Platform, args: argparse.Namespace, config: typing.Mapping[typ
     # successfully before we stop trying).
     if args.force and cache_file is not None:
         logger.debug("Wiping cache due to --force.")
-        try:
-            cache_file.unlink(True)
-        except OSError:
-            pass
-
-    # Load the cache file, if any.
+        for i in (cache_temp_filename(cache_file), cache_file):
+            try:
+                i.unlink(True)
+            except OSError:
+                pass
+
+    # Load the cache file, if any. A leftover temporary file means a previous
+    # run completed an update but was interrupted before renaming the file into
+    # place, so it is newer than the cache file itself; prefer it if it is
+    # intact, and delete it if not, so that it is not tried again every run.
+    # If neither file is present, readable, valid JSON (which includes valid
+    # UTF-8), and of the expected shape, act as if there is no cache, which
+    # results in one unconditional update.
+    cache = None
     if cache_file is not None:
-        try:
-            with cache_file.open("r") as fp:
-                cache = json.load(fp)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            cache = None
-    else:
-        cache = None
-
-    # Rip apart my hostname.
-    fqdn = dns.name.from_text(socket.getfqdn())
-    zone = fqdn.parent()
-    hostPart = fqdn.relativize(zone)
+        cache_temp_file = cache_temp_filename(cache_file)
+        for i in (cache_temp_file, cache_file):
+            try:
+                candidate = json.loads(i.read_bytes())
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as exp:
+                logger.warning("Ignoring unreadable cache file %s: %s", i, exp)
+            else:
+                cache = check_cache(candidate, logger)
+                if cache is not None:
+                    break
+                logger.warning("Ignoring cache file %s with unexpected contents.", i)
+            if i == cache_temp_file:
+                try:
+                    i.unlink(True)
+                except OSError:
+                    pass
 
-    # Find which nameserver we should talk to using an SOA query.
-    resp = dns.resolver.query(zone, dns.rdatatype.SOA)
-    if len(resp.rrset) != 1:
-        raise Exception(f"Got {len(resp.rrset)} SOA records for zone {zone}, expected 1.")
-    server = resp.rrset[0].mname.to_text(omit_final_dot=True)
-    logger.debug("Using nameserver %s.", server)
+    # Find my fully qualified hostname, in the canonical textual form the
+    # cache stores it in. Finding it can involve a reverse DNS lookup, so if the
+    # system hostname is the same as when the cache was written, reuse the
+    # fully qualified name recorded there; that also means dnspython need not
+    # be loaded if nothing turns out to have changed.
+    system_hostname = socket.gethostname()
+    if cache and cache.get("system_hostname") == system_hostname:
+        fqdn_text = cache["hostname"]
+    else:
+        import dns.name
+        fqdn_text = dns.name.from_text(socket.getfqdn(system_hostname)).to_text()
 
     # Find my addresses.
     addresses: typing.Dict[str, typing.List[IPAddressUnion]] = {family.name: [] for family in families}
-    for interface in ifaddr.get_adapters():
-        if not args.interface or interface.nice_name in args.interface:
-            for family in families:
-                addresses[family.name] += family.filter_address_list(interface.ips)
-    for family in families:
-        addresses[family.name].sort()
+    collectors = [(family.version, family.filter_address_list, addresses[family.name].extend) for family in families]
+    for ips_by_version in interface_addresses(frozenset(args.interface)).values():
+        for (version, filter_address_list, extend) in collectors:
+            # Many interfaces (e.g. IPv4-only ones) have no addresses at all in
+            # one of the families; don’t bother filtering nothing.
+            ips = ips_by_version[version]
+            if ips:
+                extend(filter_address_list(ips))
+    # The same address may be found on more than one interface (e.g. bridges or
+    # aliases), but it should only be registered once. Sorting the address
+    # objects orders them numerically (i.e. by packed value, so 9.0.0.1 comes
+    # before 10.0.0.2), not textually, which makes the order independent of
+    # how the interfaces and their addresses happened to be enumerated.
+    for (family_name, family_addresses) in addresses.items():
+        addresses[family_name] = sorted(set(family_addresses))
+
+    # The cache stores addresses as strings, so compare in that form rather
+    # than parsing every cached address back into an address object. The
+    # strings are in the canonical RFC 5952 form and the lists were sorted
+    # numerically above, so the same set of addresses always produces
+    # identical lists.
+    addresses_strings = {family: [str(a) for a in family_addresses] for (family, family_addresses) in addresses.items()}
 
     # Get the hostname and addresses most recently sent from the cache.
+    last_addresses: typing.Optional[typing.Dict[str, typing.List[str]]]
     if cache:
         last_hostname = cache.get("hostname")
-        last_addresses_strings = cache.get("addresses")
-        last_addresses: typing.Optional[typing.Dict[str, typing.List[IPAddressUnion]]]
-        if last_addresses_strings is not None:
-            last_addresses = {family: [ipaddress.ip_address(a) for a in addresses] for (family, addresses) in last_addresses_strings.items()}
-        else:
-            last_addresses = None
+        last_addresses = cache.get("addresses")
     else:
         last_hostname = None
         last_addresses = None
 
     # Check if the current hostname and addresses are the same as the last one.
-    if fqdn.to_text() == last_hostname and addresses == last_addresses:
-        logger.info("Eliding DNS record update for %s to %s as cache says addresses have not changed.", fqdn, addresses)
-    else:
-        # Construct the DNS update.
-        logger.info("Updating DNS record for %s to %s.", fqdn, addresses)
-        update = dns.update.Update(zone)
-        update.delete(hostPart)
+    # If so, stop here: none of the work below (building the update, parsing
+    # the TSIG configuration, finding the nameserver) is needed.
+    if fqdn_text == last_hostname and addresses_strings == last_addresses:
+        logger.info("Eliding DNS record update for %s to %s as cache says addresses have not changed.", fqdn_text, addresses_strings)
+        return
+
+    logger.info("Updating DNS record for %s to %s.", fqdn_text, addresses_strings)
+
+    # Rip apart my hostname.
+    import dns.name
+    import dns.tsigkeyring
+    import dns.update
+    fqdn = dns.name.from_text(fqdn_text)
+    zone = fqdn.parent()
+    hostPart = fqdn.relativize(zone)
+
+    # Construct the DNS update.
+    update = dns.update.Update(zone)
+    if fqdn_text == last_hostname and last_addresses:
+        # The cache says which records were registered last time. Require
+        # them to still be present, so that if somebody else has changed
+        # them in the meantime, the server refuses this update rather than
+        # it silently overwriting their change.
         for family in families:
-            for address in addresses[family.name]:
-                family.add_address_to_update(update, hostPart, ttl, address)
-        if "tsig" in config:
-            knownAlgorithms = {
-                "hmac-md5": dns.tsig.HMAC_MD5,
-                "hmac-sha1": dns.tsig.HMAC_SHA1,
-                "hmac-sha224": dns.tsig.HMAC_SHA224,
-                "hmac-sha256": dns.tsig.HMAC_SHA256,
-                "hmac-sha384": dns.tsig.HMAC_SHA384,
-                "hmac-sha512": dns.tsig.HMAC_SHA512,
-            }
-            if config["tsig"]["algorithm"] not in knownAlgorithms:
-                raise ValueError(f"TSIG algorithm {config['tsig']['algorithm']} not recognized.")
-            tsigAlgorithm = knownAlgorithms[config["tsig"]["algorithm"]]
-            tsigRing = dns.tsigkeyring.from_text({config["tsig"]["keyname"]: config["tsig"]["key"]})
-            update.use_tsig(keyring=tsigRing, algorithm=tsigAlgorithm)
-            logger.debug("Update will be authenticated with TSIG %s.", tsigAlgorithm)
-        else:
-            logger.debug("Update will be unauthenticated.")
-
-        # Resolve the nameserver hostname from the SOA record to one or more IP
-        # addresses, and try to send an update to each one in turn until one
-        # succeeds or they all fail.
-        server_addresses = socket.getaddrinfo(server, "domain", type=socket.SOCK_STREAM)
-        errors = []
-        for (_, _, _, _, sockaddr) in server_addresses:
-            try:
-                # Send the update.
-                server_address = sockaddr[0]
-                logger.debug("Sending update to DNS server at %s.", server_address)
-                resp = dns.query.tcp(update, where=server_address, timeout=30)
-                if resp.rcode() != dns.rcode.NOERROR:
-                    raise Exception("Update failed with rcode {resp.rrcode()}.")
-
-                # This update was successful, so no need to try the rest of the
-                # nameserver’s addresses.
-                break
-            except (OSError, dns.exception.DNSException) as exp:
-                # Hold onto the error, but don’t report it yet—try the next
-                # address instead.
-                errors.append(exp)
-        else:
-            # All the nameserver’s addresses failed. Bail out.
-            raise Exception("Unable to contact any nameservers: " + "; ".join(f"{address[4][0]}: {error}" for (address, error) in zip(server_addresses, errors)))
+            for last_address in last_addresses.get(family.name, []):
+                family.add_prerequisite_to_update(update, hostPart, last_address)
+    update.delete(hostPart)
+    for family in families:
+        for address in addresses[family.name]:
+            family.add_address_to_update(update, hostPart, ttl, address)
+    if "tsig" in config:
+        tsigAlgorithm = _TSIG_ALGORITHMS.get(config["tsig"]["algorithm"])
+        if tsigAlgorithm is None:
+            raise ValueError(f"TSIG algorithm {config['tsig']['algorithm']} not recognized.")
+        tsigRing = dns.tsigkeyring.from_text({config["tsig"]["keyname"]: config["tsig"]["key"]})
+        update.use_tsig(keyring=tsigRing, algorithm=tsigAlgorithm)
+        logger.debug("Update will be authenticated with TSIG %s.", tsigAlgorithm)
+    else:
+        logger.debug("Update will be unauthenticated.")
+    registered = frozenset(address for family_addresses in addresses_strings.values() for address in family_addresses)
+
+    # Send the update. If the cache remembers which nameserver to talk to for
+    # this zone and that information has not gone stale, use it rather than
+    # doing an SOA query and resolving the nameserver’s addresses again. If the
+    # remembered nameserver cannot be reached, or refuses the update (e.g. with
+    # NOTAUTH because it is no longer the zone’s primary), it may have moved,
+    # so look it up afresh and try once more. A failed prerequisite is about
+    # the records, not the nameserver, so that is not retried.
+    if cache and cache.get("zone") == zone.to_text() and cache["server_expires"] > time.time():
+        server, server_addresses, server_expires = cache["server"], cache["server_addresses"], cache["server_expires"]
+        logger.debug("Using cached nameserver %s.", server)
+        try:
+            send_update(update, server_addresses, fqdn, registered, logger)
+        except PrerequisiteFailedError:
+            raise
+        except (NameserverUnreachableError, UpdateRefusedError) as exp:
+            logger.debug("Cached nameserver failed, looking it up again: %s", exp)
+            server, server_addresses, server_expires = find_nameserver(zone, logger)
+            send_update(update, server_addresses, fqdn, registered, logger)
+    else:
+        server, server_addresses, server_expires = find_nameserver(zone, logger)
+        send_update(update, server_addresses, fqdn, registered, logger)
+
+    # Update the cache to remember that we did the update, and which
+    # nameserver we did it with. Write a temporary file, make sure it has
+    # reached the disk, and rename it into place, so that being interrupted
+    # part way through cannot leave a truncated cache file behind; then make
+    # sure the rename has reached the disk too. The whole file is encoded up
+    # front and written in one call.
+    if cache_file is not None:
+        cache_temp_file = cache_temp_filename(cache_file)
+        data = json.dumps({"system_hostname": system_hostname, "hostname": fqdn_text, "addresses": addresses_strings, "zone": zone.to_text(), "server": server, "server_addresses": server_addresses, "server_expires": server_expires}, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("UTF-8")
+        with cache_temp_file.open("wb") as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(cache_temp_file, cache_file)
+        platform.sync_directory(cache_file.parent)
+
 
-        # Update the cache to remember that we did the update.
-        if cache_file is not None:
-            with cache_file.open("w") as fp:
-                json.dump({"hostname": fqdn.to_text(), "addresses": addresses}, fp, ensure_ascii=False, allow_nan=False, cls=IPAddressEnabledJSONEncoder)
+# The recognized platforms, keyed by os.name. Only the one actually in use is
+# ever instantiated.
+_PLATFORMS: typing.Dict[str, typing.Callable[[], Platform]] = {
+    POSIXPlatform.name: POSIXPlatform,
+    WindowsPlatform.name: WindowsPlatform,
+}
 
 
 def main() -> None:
     # Choose a platform.
-    platform: Platform = UnknownPlatform()
-    for i in (POSIXPlatform(), WindowsPlatform()):
-        if i.name == os.name:
-            platform = i
+    platform = _PLATFORMS.get(os.name, UnknownPlatform)()
     platform.platform_specific_setup()
 
     # Parse command-line arguments.